@@ -1,145 +1,298 @@
 import pandas as pd
 import numpy as np
-import math
 import matplotlib.pyplot as plt
 
+try:
+    from numba import njit as _njit
+except ImportError:  # fall back to the plain python kernel
+    def _njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+try:
+    import pyarrow as _pa
+    import pyarrow.compute as _pc
+except ImportError:
+    _pa = None
+
 FUTURE_MONTH_MAP = {
     'F': 1, 'G': 2, 'H': 3, 'J': 4, 'K': 5, 'M': 6,
     'N': 7, 'Q': 8, 'U': 9, 'V': 10, 'X': 11, 'Z': 12
 }
 
-def _get_contract_year(row):
-    contract_year_first_digit = int(row["symbol"][3])
-    curr_year = row.name.year
-    if contract_year_first_digit < curr_year % 10:
-        contract_year = math.ceil(curr_year / 10) * 10 + contract_year_first_digit
-    else:
-        contract_year = math.floor(curr_year / 10) * 10 + contract_year_first_digit
-    return contract_year
+def _build_month_lut() -> np.ndarray:
+    # month number indexed by the byte value of the month letter, -1 for anything that isn't a month code
+    lut = np.full(256, -1, dtype=np.int8)
+    for code, month in FUTURE_MONTH_MAP.items():
+        lut[ord(code)] = month
+    return lut
+
+MONTH_LUT = _build_month_lut()
+
+def _get_symbol_length(symbols: pd.Series) -> np.ndarray:
+    if _pa is not None:
+        return _pc.utf8_length(_pa.array(symbols)).to_numpy(zero_copy_only=False)
+    return np.char.str_len(symbols.to_numpy(dtype=object).astype('U'))
 
-def _get_expiry_length(row):
-    month = FUTURE_MONTH_MAP[row['symbol'][2]]
-    year = row["contract_year"]
+def _get_contract_year(symbol_bytes: np.ndarray, index: pd.DatetimeIndex) -> np.ndarray:
+    contract_year_first_digit = symbol_bytes[:, 3].astype(np.int8) - ord('0')
+    curr_year = index.year.to_numpy()
+    last_digit = curr_year % 10
+    decade = curr_year - last_digit
+    # a digit below the current year's last digit belongs to the next decade
+    return decade + contract_year_first_digit + np.where(contract_year_first_digit < last_digit, 10, 0)
+
+def _get_expiry_length(df: pd.DataFrame) -> np.ndarray:
     # Calculate the difference in months
-    return (year - row.name.year) * 12 + month - row.name.month
-
-def _get_near_roll_date(row, DAYS_BEFORE_EXPIRY):
-    year = row["contract_year"]
-    month = row["contract_month"]
-    # Get all business days in the contract month
-    # Using a fixed day like 28 to be safe for all months
-    start_of_month = pd.to_datetime(f"{year}-{month:02d}-01").tz_localize('America/Chicago')
-    end_of_month = start_of_month + pd.offsets.MonthEnd(0)
-    bdays = pd.bdate_range(start=start_of_month, end=end_of_month)
+    expiry_length = (df["contract_year"].to_numpy() - df.index.year.to_numpy()) * 12 + df["contract_month"].to_numpy() - df.index.month.to_numpy()
+    return expiry_length.astype(np.int16)
+
+def _get_near_roll_date(years, months, DAYS_BEFORE_EXPIRY) -> pd.DatetimeIndex:
+    # Last calendar day of each contract month
+    contract_months = np.array([f"{year}-{month:02d}" for year, month in zip(years, months)], dtype='datetime64[M]')
+    end_of_month = (contract_months + np.timedelta64(1, 'M')).astype('datetime64[D]') - np.timedelta64(1, 'D')
     # The roll date is 3 days before the 3rd to last business day
-    roll_date = bdays[-3] - pd.DateOffset(days=DAYS_BEFORE_EXPIRY)
-    if roll_date.weekday() == 5: # If it's a Saturday or Sunday
-        roll_date = roll_date - pd.Timedelta(days=1)
-    return roll_date
+    third_last_bday = np.busday_offset(end_of_month, -2, roll='backward')
+    roll_date = third_last_bday - np.timedelta64(DAYS_BEFORE_EXPIRY, 'D')
+    # 1970-01-01 was a Thursday, so Monday == 0 and Saturday == 5
+    weekday = (roll_date.astype(np.int64) + 3) % 7
+    roll_date = np.where(weekday == 5, roll_date - np.timedelta64(1, 'D'), roll_date)
+    return pd.DatetimeIndex(roll_date.astype('datetime64[ns]')).tz_localize('America/Chicago')
+
+
+@_njit(cache=True, nogil=True, boundscheck=False)
+def _roll_adjust(codes, open_, close, adjustment, total_adjustment):
+    n = len(codes)
+    # forward pass: spread between the next contract's open and the expiring contract's close
+    for i in range(n - 1):
+        if codes[i] != codes[i + 1]:
+            spread = open_[i + 1] - close[i]
+            adjustment[i] = 0.0 if np.isnan(spread) else spread
+        else:
+            adjustment[i] = 0.0
+    if n > 0:
+        adjustment[n - 1] = 0.0
+    # backward pass: reverse cumulative sum of adjustments
+    running = 0.0
+    for i in range(n - 1, -1, -1):
+        running += adjustment[i]
+        total_adjustment[i] = running
 
 
 def combine_features(df: pd.DataFrame, near_roll: bool = False, DAYS_BEFORE_EXPIRY: int = 3) -> pd.DataFrame:
-    # filter for vanilla futures contracts
-    single_contract_filter = (df["symbol"].str.len() == 4)
-    fdf = df[single_contract_filter].copy()
+    # work on the unique symbols only and map back through the categorical codes
+    symbols = df["symbol"].astype('category')
+    categories = symbols.cat.categories
+    codes = symbols.cat.codes.to_numpy()
+
+    # filter for vanilla futures contracts: 4 chars with a valid month letter and year digit
+    vanilla = _get_symbol_length(pd.Series(categories)) == 4
+    # view the 4-char symbols as a (K, 4) byte array, parsed once per unique symbol
+    category_bytes = np.zeros((len(categories), 4), dtype=np.uint8)
+    category_bytes[vanilla] = categories[vanilla].str.encode('ascii', errors='replace').to_numpy(dtype='S4').view(np.uint8).reshape(-1, 4)
+    year_digit = category_bytes[:, 3]
+    vanilla &= (MONTH_LUT[category_bytes[:, 2]] > 0) & (year_digit >= ord('0')) & (year_digit <= ord('9'))
+    single_contract_filter = (codes >= 0) & vanilla[codes]
+    fdf = df[single_contract_filter]
+    fdf["symbol"] = symbols[single_contract_filter].cat.remove_unused_categories().array
 
     # adding necessary data
-    fdf["contract_year"] = fdf.apply(_get_contract_year, axis=1)
-    fdf["contract_month"] = fdf.apply(lambda row: FUTURE_MONTH_MAP[row['symbol'][2]], axis=1)
-    fdf["expiry_length"] = fdf.apply(_get_expiry_length, axis=1)
+    symbol_codes = fdf["symbol"].cat.codes.to_numpy()
+    symbol_bytes = category_bytes[codes[single_contract_filter]]
+    fdf["contract_year"] = _get_contract_year(symbol_bytes, fdf.index)
+    fdf["contract_month"] = MONTH_LUT[symbol_bytes[:, 2]]
+    fdf["expiry_length"] = _get_expiry_length(fdf)
+    # integer symbol codes for cheap equality checks downstream
+    fdf["symbol_code"] = symbol_codes.astype(np.int32)
+    fdf.attrs["symbols"] = tuple(fdf["symbol"].cat.categories)
 
     if near_roll:
-        fdf['contract_roll_date'] = fdf.apply(lambda x: _get_near_roll_date(x, DAYS_BEFORE_EXPIRY), axis=1)
+        # roll date only depends on the contract, so compute it once per contract month
+        pairs = pd.MultiIndex.from_arrays([fdf["contract_year"], fdf["contract_month"]]).unique()
+        roll_dates = _get_near_roll_date(pairs.get_level_values(0), pairs.get_level_values(1), DAYS_BEFORE_EXPIRY)
+        cache = dict(zip(pairs, roll_dates))
+        fdf['contract_roll_date'] = list(map(cache.get, zip(fdf["contract_year"], fdf["contract_month"])))
 
     return fdf
 
 def near_roll(df: pd.DataFrame, DAYS_BEFORE_EXPIRY: int = 3,verbose: bool = False) -> pd.DataFrame:
     # split into front month and second month
-    frdf = df[df["expiry_length"] == 0].copy()
-    sdf = df[df["expiry_length"] == 1].copy()
+    frdf = df[df["expiry_length"] == 0]
+    sdf = df[df["expiry_length"] == 1]
 
     # split into pre roll front month and post roll second month
-    adj_frdf = frdf[frdf.index < frdf['contract_roll_date']].copy()
+    adj_frdf = frdf[frdf.index < frdf['contract_roll_date']]
 
     # need to align because second month df doesn't have first month expiration date info
     common_idx = frdf.index.intersection(sdf.index)
-    sdf.loc[common_idx, 'fm_roll_date'] = frdf.loc[common_idx, 'contract_roll_date'].copy()
-    adj_sdf = sdf[sdf.index >= sdf['fm_roll_date']].copy()
+    sdf.loc[common_idx, 'fm_roll_date'] = frdf.loc[common_idx, 'contract_roll_date']
+    adj_sdf = sdf[sdf.index >= sdf['fm_roll_date']]
 
-    # combine adjusted dataframes
-    ndf = pd.concat([adj_frdf, adj_sdf], axis=0).sort_index()
+    # combine adjusted dataframes (both are already time-ordered, so a stable merge sort is near-linear)
+    ndf = pd.concat([adj_frdf, adj_sdf], axis=0).sort_index(kind='mergesort')
 
     # determine roll spread 
     is_roll_day = ndf.index.date == ndf['contract_roll_date'].dt.date if 'contract_roll_date' in ndf.columns else np.zeros(len(ndf), dtype=bool)
 
-    # adj for roll
-    adjustment = np.where(
-        is_roll_day,
-        ndf['open'].shift(-1) - ndf['close'],
-        0
-    )
+    # adj for roll, only computing the spread on roll days (the last row has no next open)
+    adjustment = np.zeros(len(ndf), dtype=np.float64)
+    roll_idx = np.flatnonzero(is_roll_day)
+    roll_idx = roll_idx[roll_idx < len(ndf) - 1]
+    next_open = ndf['open'].to_numpy(dtype=np.float64)
+    close = ndf['close'].to_numpy(dtype=np.float64)
+    spread = next_open[roll_idx + 1] - close[roll_idx]
+    # only roll-day spreads can be missing, so clean them before scattering into the zeroed array
+    adjustment[roll_idx] = np.where(np.isnan(spread), 0, spread)
 
-    ndf['adjustment'] = np.where(np.isnan(adjustment), 0, adjustment)
-    total_adjustment = ndf['adjustment'].iloc[::-1].cumsum().iloc[::-1].shift(-1)
-    total_adjustment = np.where(np.isnan(total_adjustment), 0, total_adjustment)
+    ndf['adjustment'] = adjustment
+    # reverse cumulative sum of adjustments, shifted forward by one day
+    cumulative_adjustment = np.cumsum(ndf['adjustment'].to_numpy()[::-1])[::-1]
+    total_adjustment = np.zeros_like(cumulative_adjustment)
+    total_adjustment[:-1] = cumulative_adjustment[1:]
 
     cols_to_adjust = ['open', 'high', 'low', 'close']
-    ndf[cols_to_adjust] = ndf[cols_to_adjust].add(total_adjustment, axis=0)
+    adjusted = ndf[cols_to_adjust].to_numpy(dtype=np.float64, copy=True)
+    adjusted += total_adjustment.reshape(-1, 1)
+    ndf[cols_to_adjust] = adjusted
     
 
     return ndf
 
-def generic_roll(df: pd.DataFrame, length: int, verbose: bool = False) -> pd.DataFrame:
+def apply_rolls(ndf: pd.DataFrame) -> pd.DataFrame:
+    """
+    Back-adjusts the OHLC prices of a one-row-per-day contract series in place using the compiled roll kernel.
+    """
+    # identify roll days and apply a reverse cumulative sum of adjustments in one fused kernel
+    adjustment = np.empty(len(ndf), dtype=np.float64)
+    total_adjustment = np.empty(len(ndf), dtype=np.float64)
+    _roll_adjust(
+        np.ascontiguousarray(ndf['symbol_code'].to_numpy(), dtype=np.int32),
+        np.ascontiguousarray(ndf['open'].to_numpy(), dtype=np.float64),
+        np.ascontiguousarray(ndf['close'].to_numpy(), dtype=np.float64),
+        adjustment,
+        total_adjustment,
+    )
+    ndf['adjustment'] = adjustment
+
+    cols_to_adjust = ['open', 'high', 'low', 'close']
+    adjusted = ndf[cols_to_adjust].to_numpy(dtype=np.float64, copy=True)
+    adjusted += total_adjustment.reshape(-1, 1)
+    ndf[cols_to_adjust] = adjusted
+
+    return ndf
+
+def split_by_expiry(df: pd.DataFrame) -> dict:
+    """
+    Partitions the detailed dataframe into one bucket per expiry length.
+    """
+    return {length: group for length, group in df.groupby('expiry_length', sort=True)}
+
+def generic_roll(df: pd.DataFrame, length: int, verbose: bool = False, by_expiry: dict = None) -> pd.DataFrame:
     """
     Creates a continuous, price-adjusted futures series by rolling contracts.
+    Pass the output of split_by_expiry as by_expiry to skip re-filtering df on repeated calls.
     """
-    # filter for contracts with the target expiry length or the next one
-    candidates = df[df['expiry_length'].isin([length, length + 1])].copy()
+    # filter for contracts with the target expiry length or the next one, keeping only the columns we need
+    cols = ['symbol', 'symbol_code', 'open', 'high', 'low', 'close', 'volume', 'expiry_length']
+    if by_expiry is not None:
+        buckets = [by_expiry[i].loc[:, cols] for i in (length, length + 1) if i in by_expiry]
+        candidates = pd.concat(buckets) if buckets else df.loc[df.index[:0], cols]
+    else:
+        candidates = df.loc[df['expiry_length'].isin([length, length + 1]), cols]
     
-    # use a clean date column for daily selection
-    candidates['date'] = pd.to_datetime(candidates.index.date)
-
-    # for each day, prefer the contract with the shorter expiry length
-    candidates.sort_values(by=['date', 'expiry_length'], inplace=True)
-    ndf = candidates.drop_duplicates(subset='date', keep='first').set_index('date')
+    # for each day, prefer the contract with the shorter expiry length:
+    # a stable lexsort on (date, expiry_length) then the first row of each date
+    dates = candidates.index.normalize().tz_localize(None)
+    date_values = dates.asi8
+    order = np.lexsort((candidates['expiry_length'].to_numpy(), date_values))
+    _, first = np.unique(date_values[order], return_index=True)
+    ndf = candidates.iloc[order[first]]
+    ndf.index = dates[order[first]].rename('date')
 
     if verbose:
         missing_days = ndf['close'].isna().sum()
         print(f"no valid contract found for {missing_days} business days before filling.")
     
-    # identify the day before the contract roll to calculate the adjustment
-    is_roll_day = ndf['symbol'] != ndf['symbol'].shift(-1)
-
-    # calculate price adjustment using a forward-looking shift (-1)
-    adjustment = np.where(
-        is_roll_day,
-        ndf['open'].shift(-1) - ndf['close'],
-        0
-    )
-    ndf['adjustment'] = np.where(np.isnan(adjustment), 0, adjustment)
-    
-    # apply a reverse cumulative sum of adjustments to create a continuous series
-    total_adjustment = ndf['adjustment'].iloc[::-1].cumsum().iloc[::-1]
-    
+    return apply_rolls(ndf)
+
+def generic_roll_all(df: pd.DataFrame, lengths=range(1, 13), verbose: bool = False) -> dict:
+    """
+    Creates the generic_roll series for every length in lengths at once.
+    Prices are pivoted to a (date, length) grid so roll detection and the reverse cumulative sum run as 2-D array ops.
+    """
+    cols = ['symbol', 'symbol_code', 'open', 'high', 'low', 'close', 'volume', 'expiry_length']
+    lengths = list(lengths)
+    lo, hi = min(lengths), max(lengths) + 1
+
+    # positional row of the first contract for each (date, expiry_length), -1 where there is none
+    date_codes, dates = pd.factorize(df.index.normalize().tz_localize(None), sort=True)
+    expiry_length = df['expiry_length'].to_numpy()
+    pos = np.flatnonzero((expiry_length >= lo) & (expiry_length <= hi))
+    width = hi - lo + 1
+    _, first = np.unique(date_codes[pos] * width + expiry_length[pos] - lo, return_index=True)
+    pos = pos[first]
+    row_pos = np.full((len(dates), width), -1, dtype=np.int64)
+    row_pos[date_codes[pos], expiry_length[pos] - lo] = pos
+
+    # for each day, prefer the contract with the shorter expiry length
+    length_idx = np.array(lengths) - lo
+    chosen = np.where(row_pos[:, length_idx] >= 0, row_pos[:, length_idx], row_pos[:, length_idx + 1])
+    valid = chosen >= 0
+    codes = np.where(valid, df['symbol_code'].to_numpy()[chosen], -1)
+    open_ = np.where(valid, df['open'].to_numpy(dtype=np.float64)[chosen], np.nan)
+    close = np.where(valid, df['close'].to_numpy(dtype=np.float64)[chosen], np.nan)
+
+    # next day with a contract, per length
+    n_dates = len(dates)
+    day = np.where(valid, np.arange(n_dates)[:, None], n_dates)
+    next_day = np.full_like(day, n_dates)
+    next_day[:-1] = np.minimum.accumulate(day[::-1], axis=0)[::-1][1:]
+    has_next = valid & (next_day < n_dates)
+    next_day = np.minimum(next_day, max(n_dates - 1, 0))
+    column = np.arange(len(lengths))
+
+    # roll adjustment and its reverse cumulative sum across all lengths at once
+    spread = open_[next_day, column] - close
+    is_roll_day = has_next & (codes[next_day, column] != codes) & ~np.isnan(spread)
+    adjustment = np.where(is_roll_day, spread, 0.0)
+    total_adjustment = np.cumsum(adjustment[::-1], axis=0)[::-1]
+
     cols_to_adjust = ['open', 'high', 'low', 'close']
-    ndf[cols_to_adjust] = ndf[cols_to_adjust].add(total_adjustment, axis=0)
+    rolled = {}
+    for j, length in enumerate(lengths):
+        rows = np.flatnonzero(valid[:, j])
+        ndf = df.iloc[chosen[rows, j]].loc[:, cols]
+        ndf.index = dates[rows].rename('date')
+        if verbose:
+            missing_days = ndf['close'].isna().sum()
+            print(f"length {length}: no valid contract found for {missing_days} business days before filling.")
+        ndf['adjustment'] = adjustment[rows, j]
+        adjusted = ndf[cols_to_adjust].to_numpy(dtype=np.float64, copy=True)
+        adjusted += total_adjustment[rows, j].reshape(-1, 1)
+        ndf[cols_to_adjust] = adjusted
+        rolled[length] = ndf
 
-    return ndf
+    return rolled
 
 if __name__ == "__main__":
     # sample usage
     df = pd.read_csv('Data/gold_futures_ohlcv.csv', parse_dates=['ts_event'])
     df["ts_event"] = pd.to_datetime(df["ts_event"]).dt.tz_convert('America/Chicago')
     df = df.set_index('ts_event', inplace=False)
+    df["symbol"] = df["symbol"].astype('category')
 
     detailed_df = combine_features(df, False, 3)
+    by_expiry = split_by_expiry(detailed_df)
+
+    rolled = generic_roll_all(detailed_df, range(1, 13), False)
 
-    for i in range(1, 13):
-        test = generic_roll(detailed_df, i, False)
+    for i, test in rolled.items():
         if i == 1:
             compare = test.copy()
             print(test.iloc[-35:-25])
-        default = detailed_df[(detailed_df['expiry_length'] == i) | (detailed_df['expiry_length'] == i + 1)]
+        buckets = [by_expiry[j] for j in (i, i + 1) if j in by_expiry]
+        default = pd.concat(buckets) if buckets else detailed_df.iloc[:0]
         print(i)
         if not test.empty:
             print(test.index.nunique(), "/", default.index.nunique())